@@ -0,0 +1,64 @@
+import numpy as np
+from numba import njit, prange
+from numba import get_num_threads as get_numba_threads
+from numba import set_num_threads as set_numba_threads
+
+# fastmath without 'ninf'/'nnan', since _assign compares against np.inf
+FASTMATH_FLAGS = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+@njit(parallel=True, fastmath=FASTMATH_FLAGS, cache=True)
+def _assign(X, C, labels):
+    '''Assigns each point to its nearest centroid. Returns True if any label changed.'''
+    N, D = X.shape
+    k = C.shape[0]
+    changed = np.zeros(N, dtype=np.bool_)
+    for i in prange(N):
+        best = 0
+        bd = np.inf
+        for c in range(k):
+            d = 0.0
+            for j in range(D):
+                t = X[i, j] - C[c, j]
+                d += t * t
+            if d < bd:
+                bd = d
+                best = c
+        if labels[i] != best:
+            labels[i] = best
+            changed[i] = True
+    return changed.any()
+
+@njit(fastmath=FASTMATH_FLAGS, cache=True)
+def _update(X, labels, C):
+    '''Moves each centroid to the mean of its points. Empty clusters keep their centroid.'''
+    N, D = X.shape
+    k = C.shape[0]
+    sums = np.zeros((k, D), dtype=X.dtype)
+    counts = np.zeros(k, dtype=np.int64)
+    for i in range(N):
+        c = labels[i]
+        counts[c] += 1
+        for j in range(D):
+            sums[c, j] += X[i, j]
+    for c in range(k):
+        if counts[c] > 0:
+            for j in range(D):
+                C[c, j] = sums[c, j] / counts[c]
+
+@njit(cache=True)
+def lloyd(X, C, n_iter):
+    '''Runs Lloyd's algorithm from initial centroids C, updated in place.'''
+    labels = np.full(X.shape[0], -1, dtype=np.int64)
+    for _ in range(n_iter):
+        if not _assign(X, C, labels):
+            break
+        _update(X, labels, C)
+    return C
+
+def kmeans_lloyd(X, n_clusters, n_iter=100, random_state=0):
+    '''K-means on a contiguous float32 array, initialized from random data points.
+    Returns cluster centers (n_clusters, feat_dim).'''
+    rng = np.random.RandomState(random_state)
+    init = rng.choice(len(X), size=n_clusters, replace=False)
+    C = np.ascontiguousarray(X[init])
+    return lloyd(X, C, n_iter)
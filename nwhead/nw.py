@@ -36,8 +36,9 @@ class NWNet(nn.Module):
 
         :param featurizer: Feature extractor
         :param n_classes: Number of classes in dataset
-        :param support_dataset: Pytorch Dataset object. Assumes has attributes
-            .targets containing categorical classes of dataset.
+        :param support_dataset: Pytorch Dataset object, or list of Dataset objects
+            (one per environment). Assumes has attributes .targets containing
+            categorical classes of dataset.
         :param feat_dim: Output dimension of featurizer
         :param proj_dim: If > 0, adds a linear projection down to proj_dim after featurizer
         :param kernel_type: Type of kernel to use
@@ -72,7 +73,10 @@ class NWNet(nn.Module):
         self.device = device
         self.return_mask = return_mask
         if support_dataset is not None:
-            assert hasattr(support_dataset, 'targets'), 'Support set must have .targets attribute'
+            if isinstance(support_dataset, (list, tuple)):
+                assert all(hasattr(d, 'targets') for d in support_dataset), 'Support sets must have .targets attribute'
+            else:
+                assert hasattr(support_dataset, 'targets'), 'Support set must have .targets attribute'
 
         # Kernel
         self.kernel = get_kernel(kernel_type)
@@ -100,6 +104,7 @@ class NWNet(nn.Module):
                                       n_shot_cluster=self.n_shot_cluster,
                                       n_neighbors=self.n_neighbors,
                                       env_array=self.env_array,
+                                      device=self.device,
                                       )
 
     def process_support_eval(self, support_dataset):
@@ -111,6 +116,7 @@ class NWNet(nn.Module):
                                       n_shot_cluster=self.n_shot_cluster,
                                       n_neighbors=self.n_neighbors,
                                       env_array=self.env_array,
+                                      device=self.device,
                                       )
 
     def precompute(self):
@@ -143,7 +149,7 @@ class NWNet(nn.Module):
             num_envs = len(sfeat)
             for env_feat, env_y in zip(sfeat, sy):
                 env_feat, env_y = env_feat.to(
-                    x.device), env_y.to(x.device)
+                    x.device, non_blocking=True), env_y.to(x.device, non_blocking=True)
                 output = self.nwhead(qfeat, env_feat, env_y)
                 outputs += output.exp()
             if self.return_mask:
@@ -151,7 +157,7 @@ class NWNet(nn.Module):
             else:
                 return torch.log(outputs / num_envs)
         else:
-            sfeat, sy = sfeat.to(x.device), sy.to(x.device)
+            sfeat, sy = sfeat.to(x.device, non_blocking=True), sy.to(x.device, non_blocking=True)
             if self.return_mask:
                 return self.nwhead(qfeat, sfeat, sy), torch.full((len(x),), True)
             else:
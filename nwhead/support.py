@@ -1,8 +1,25 @@
+import collections
+import os
 import numpy as np
-import random
 import torch
 from torch.utils.data import Dataset, ConcatDataset
-from .utils import DatasetMetadata, FeatureDataset, InfiniteUniformClassLoader, FullDataset, HNSW, KNN, compute_clusters
+from .utils import DatasetMetadata, FeatureDataset, InfiniteUniformClassLoader, RandomEnvLoader, BackgroundLoader, FullDataset, HNSW, KNN, compute_clusters, groupby_indices
+
+# Number of recent knn/hnsw query batches whose supports are memoized
+SUPPORT_CACHE_SIZE = 4
+
+def _as_int32(arr, name):
+    '''Casts integer-valued ids to int32, failing loudly instead of truncating.'''
+    arr = np.asarray(arr)
+    if np.issubdtype(arr.dtype, np.floating):
+        if not np.all(arr == np.round(arr)):
+            raise ValueError(f'{name} must contain integer values')
+    elif not np.issubdtype(arr.dtype, np.integer):
+        raise ValueError(f'{name} must contain integers, got dtype {arr.dtype}')
+    info = np.iinfo(np.int32)
+    if len(arr) and (arr.min() < info.min or arr.max() > info.max):
+        raise ValueError(f'{name} values must fit in int32')
+    return arr.astype(np.int32, copy=False)
 
 class SupportSet:
     '''Support set base class for NW.'''
@@ -11,45 +28,54 @@ class SupportSet:
                  n_classes,
                  env_array=None,
                  ):
-        self.y_array = np.array(support_set.targets)
+        # Converted to int32 by _set_label_env_arrays; asarray avoids an extra copy
+        if hasattr(support_set, 'targets'):
+            self.y_array = np.asarray(support_set.targets)
+        else:
+            self.y_array = np.concatenate([np.asarray(ds.targets) for ds in support_set])
         self.n_classes = n_classes
 
         # If env_array is provided, then support dataset should be a single
         # Pytorch Dataset. 
         if env_array is not None:
-            self.env_array = env_array
+            self._set_label_env_arrays(env_array)
+            self._env_index = groupby_indices(self.env_array)
             support_set = DatasetMetadata(support_set, self.env_array)
             self.combined_dataset = support_set
             self.env_datasets = self._separate_env_datasets(support_set)
         # Otherwise, it should be a list of Datasets.
         elif env_array is None and all(isinstance(d, Dataset) for d in support_set):
             assert all(isinstance(d, Dataset) for d in support_set)
-            self.env_array = []
-            for i, ds in enumerate(support_set):
-                self.env_array += [i for _ in range(len(ds))]
-            support_set = DatasetMetadata(support_set, self.env_array)
-            self.env_datasets = support_set
-            self.combined_dataset = self._combine_env_datasets(support_set)
+            lengths = np.fromiter((len(ds) for ds in support_set), dtype=np.int64)
+            self._set_label_env_arrays(np.repeat(np.arange(len(lengths), dtype=np.int32), lengths))
+            offsets = np.concatenate([[0], lengths.cumsum()])
+            self.env_datasets = [DatasetMetadata(ds, self.env_array[offsets[i]:offsets[i+1]])
+                                 for i, ds in enumerate(support_set)]
+            self.combined_dataset = self._combine_env_datasets(self.env_datasets)
         # Simplest case, no environment info and single support dataset
         else:
-            self.env_array = np.zeros(len(support_set))
+            self._set_label_env_arrays(np.zeros(len(support_set), dtype=np.int32))
+            self._env_index = groupby_indices(self.env_array)
             support_set = DatasetMetadata(support_set, self.env_array)
             self.combined_dataset = support_set
             self.env_datasets = self._separate_env_datasets(support_set)
 
+    def _set_label_env_arrays(self, env_array):
+        '''Stores labels and environments as contiguous int32 arrays.'''
+        self.y_array = _as_int32(self.y_array, 'Support targets')
+        self.env_array = _as_int32(env_array, 'env_array')
+
     def _combine_env_datasets(self, env_datasets):
         self.env_map = {i:i for i in range(len(env_datasets))}
         combined_dataset = ConcatDataset(env_datasets)
-        combined_dataset.targets = np.concatenate([env.targets for env in self.env_datasets])
+        combined_dataset.targets = self.y_array
         assert len(combined_dataset) == len(combined_dataset.targets)
         return combined_dataset
 
     def _separate_env_datasets(self, combined_dataset):
+        self.env_map = {attr:i for i, attr in enumerate(self._env_index)}
         env_datasets = []
-        self.env_map = {}
-        for i, attr in enumerate(np.unique(self.env_array)):
-            self.env_map[attr] = i
-            indices = (self.env_array==attr).nonzero()[0]
+        for indices in self._env_index.values():
             env_dataset = torch.utils.data.Subset(combined_dataset, indices)
             env_dataset.targets = self.y_array[indices]
             env_datasets.append(env_dataset)
@@ -73,12 +99,7 @@ class SupportSetTrain(SupportSet):
 
     def get_support(self, y):
         '''Samples a support for training.'''
-        if self.train_type == 'irm':
-            train_iter = np.random.choice(self.train_iter)
-            sx, sy, sm = train_iter.next()
-        else:
-            sx, sy, sm = self.train_iter.next(y)
-
+        sx, sy, sm = self.train_iter.next(y)
         return sx, sy, sm
 
     def _build_iter(self):
@@ -88,8 +109,15 @@ class SupportSetTrain(SupportSet):
             train_iter = InfiniteUniformClassLoader(
                 self.combined_dataset, self.n_shot, 
                 self.n_way)
+            # Sampled classes depend on the query labels when n_way is set,
+            # so batches can only be prefetched without it.
+            if not self.n_way:
+                train_iter = BackgroundLoader(train_iter, max_prefetch=4)
         else:
-            train_iter = [iter(InfiniteUniformClassLoader(env, self.n_shot)) for env in self.env_datasets]
+            # A single prefetch worker picks the environment for each support
+            train_iter = BackgroundLoader(RandomEnvLoader(
+                [InfiniteUniformClassLoader(env, self.n_shot) for env in self.env_datasets]),
+                max_prefetch=4)
         return train_iter
 
 class SupportSetEval(SupportSet):
@@ -102,57 +130,135 @@ class SupportSetEval(SupportSet):
                  n_shot_cluster=3,
                  n_neighbors=20,
                  env_array=None,
+                 device=None,
                  ):
         super().__init__(support_set, n_classes, env_array)
+        self.device = device
         self.n_shot_random = n_shot_random
         self.n_shot_full = n_shot_full
         self.n_shot_cluster = n_shot_cluster
         self.n_neighbors = n_neighbors
+        self._reset_infer_iters()
         self.support_loaders = self._build_full_loader()
 
     def build_infer_iters(self, sfeat, sy, smeta, sfeat_env, sy_env, smeta_env):
         # Full
-        self.full_feat = sfeat
-        self.full_y = sy
+        # Convert once, so downstream ops do not repeatedly copy or cast
+        self.full_feat = sfeat.detach().contiguous().float()
+        self.full_y = sy.detach().contiguous().long()
         self.full_meta = smeta
-        self.full_feat_sep = sfeat_env
-        self.full_y_sep = sy_env
+        self.full_feat_sep = [f.detach().contiguous().float() for f in sfeat_env]
+        self.full_y_sep = [y.detach().contiguous().long() for y in sy_env]
         self.full_meta_sep = smeta_env
+        # Squared norms shared by all distance computations
+        self.full_feat_sq = (self.full_feat * self.full_feat).sum(dim=1)
+        # Pin in place so that 'full' and 'ensemble' supports can be copied
+        # to the GPU with non_blocking transfers on every batch
+        if torch.cuda.is_available():
+            self.full_feat = self.full_feat.pin_memory()
+            self.full_y = self.full_y.pin_memory()
+            self.full_feat_sep = [f.pin_memory() for f in self.full_feat_sep]
+            self.full_y_sep = [y.pin_memory() for y in self.full_y_sep]
+
+        # Cluster, random, KNN and HNSW supports are built lazily on first use
+        self._reset_infer_iters()
+
+    def _reset_infer_iters(self):
+        self._clusters = None
+        self._random_iter = None
+        self._knn = None
+        self._hnsw = None
+        self._support_cache = collections.OrderedDict()
 
-        # Cluster
-        self.cluster_feat, self.cluster_y = compute_clusters(self.full_feat, self.full_y, self.n_shot_cluster)
+    @property
+    def cluster_feat(self):
+        return self._get_clusters()[0]
 
-        # Random
-        feat_dataset = FeatureDataset(self.full_feat, self.full_y, self.full_meta)
-        eval_loader = InfiniteUniformClassLoader(
-            feat_dataset, self.n_shot_random)
-        self.random_iter = iter(eval_loader)
+    @property
+    def cluster_y(self):
+        return self._get_clusters()[1]
 
-        # KNN and HNSW
-        self.knn = KNN(self.full_feat, self.full_y, n_neighbors=self.n_neighbors)
-        self.hnsw = HNSW(self.full_feat, self.full_y, n_neighbors=self.n_neighbors)
+    def _get_clusters(self):
+        if self._clusters is None:
+            self._label_index = groupby_indices(self.full_y)
+            cluster_feat, cluster_y = compute_clusters(
+                self.full_feat, self.full_y, self.n_shot_cluster,
+                label_index=self._label_index, embeddings_sq=self.full_feat_sq)
+            # Move once to the inference device; get_support returns the same tensors every call
+            device = self.device if self.device is not None else self.full_feat.device
+            self._clusters = (cluster_feat.to(device, non_blocking=True).contiguous(),
+                              cluster_y.to(device, non_blocking=True).contiguous())
+        return self._clusters
+
+    @property
+    def random_iter(self):
+        if self._random_iter is None:
+            feat_dataset = FeatureDataset(self.full_feat, self.full_y, self.full_meta)
+            eval_loader = InfiniteUniformClassLoader(
+                feat_dataset, self.n_shot_random)
+            self._random_iter = iter(eval_loader)
+        return self._random_iter
+
+    @property
+    def knn(self):
+        if self._knn is None:
+            self._knn = KNN(self.full_feat, self.full_y, n_neighbors=self.n_neighbors,
+                            data_sq=self.full_feat_sq)
+        return self._knn
+
+    @property
+    def hnsw(self):
+        if self._hnsw is None:
+            self._hnsw = HNSW(self.full_feat, self.full_y, n_neighbors=self.n_neighbors)
+        return self._hnsw
 
     def get_support(self, mode, x=None):
         '''Samples a support for inference depending on mode.'''
-        try:
-            if mode == 'random':
-                sfeat, sy, _ = self.random_iter.next()
-            elif mode == 'full':
-                sfeat, sy = self.full_feat, self.full_y
-            elif mode == 'cluster':
-                sfeat, sy = self.cluster_feat, self.cluster_y
-            elif mode == 'ensemble':
-                sfeat, sy = self.full_feat_sep, self.full_y_sep
-            elif mode == 'knn':
-                sfeat, sy = self.knn(x)
-            elif mode == 'hnsw':
-                sfeat, sy = self.hnsw(x)
-            else:
-                raise NotImplementedError
-            return sfeat, sy
-        except AttributeError:
+        self._check_precomputed()
+        if mode == 'random':
+            sfeat, sy, _ = self.random_iter.next()
+        elif mode == 'full':
+            sfeat, sy = self.full_feat, self.full_y
+        elif mode == 'cluster':
+            sfeat, sy = self.cluster_feat, self.cluster_y
+        elif mode == 'ensemble':
+            sfeat, sy = self.full_feat_sep, self.full_y_sep
+        elif mode in ('knn', 'hnsw'):
+            sfeat, sy = self._cached_neighbor_support(mode, x)
+        else:
+            raise NotImplementedError
+        return sfeat, sy
+
+    def _check_precomputed(self):
+        if not hasattr(self, 'full_feat'):
             raise AttributeError('Did you run precompute()?')
 
+    def _cached_neighbor_support(self, mode, x):
+        '''Memoizes knn/hnsw supports for the most recent query batches.
+        The cache holds a reference to x, so its data_ptr cannot be reused
+        by another tensor while the entry is alive.'''
+        key = (mode, int(x.data_ptr()), tuple(x.shape), x.stride(), x.dtype, x.device,
+               getattr(x, '_version', 0))
+        if key in self._support_cache:
+            self._support_cache.move_to_end(key)
+            return self._support_cache[key][1]
+        support = self.knn(x) if mode == 'knn' else self.hnsw(x)
+        self._support_cache[key] = (x, support)
+        if len(self._support_cache) > SUPPORT_CACHE_SIZE:
+            self._support_cache.popitem(last=False)
+        return support
+
+    def get_support_batched(self, mode, x):
+        '''Retrieves a separate support for each query in batch x.
+        Returns support features (b, n_neighbors, feat_dim) and labels (b, n_neighbors).'''
+        self._check_precomputed()
+        if mode == 'knn':
+            return self.knn.batched(x)
+        elif mode == 'hnsw':
+            return self.hnsw.batched(x)
+        else:
+            raise NotImplementedError
+
     def _build_full_loader(self):
         '''Full loader for precomputing features during evaluation.
         Because the model assumes balanced classes during training and
@@ -161,5 +267,9 @@ class SupportSetEval(SupportSet):
         self.full_datasets = []
         for env in self.env_datasets:
             self.full_datasets.append(FullDataset(env, self.n_shot_full))
+        # Workers are not persistent, so no processes idle between precompute() calls
+        num_workers = max(1, min(4, (os.cpu_count() or 2) // 2))
         return [torch.utils.data.DataLoader(
-                env, batch_size=128, shuffle=False, num_workers=0) for env in self.full_datasets]
\ No newline at end of file
+                env, batch_size=128, shuffle=False, num_workers=num_workers,
+                pin_memory=torch.cuda.is_available(), prefetch_factor=4)
+                for env in self.full_datasets]
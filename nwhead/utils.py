@@ -1,8 +1,16 @@
+import os
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset
 import hnswlib
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from joblib import Parallel, delayed
+from threadpoolctl import threadpool_limits
+
+try:
+    from ._kmeans_nb import kmeans_lloyd, get_numba_threads, set_numba_threads
+except ImportError:
+    kmeans_lloyd = None
 
 class DatasetMetadata(Dataset):
     def __init__(self, dataset, metadata):
@@ -37,15 +45,13 @@ class FullDataset(Dataset):
         super().__init__()
         self.underlying_dataset = underlying_dataset
         y_array = underlying_dataset.targets
-        self.indices = get_separated_indices(y_array)
+        self.indices = list(groupby_indices(y_array).values())
 
         # Ensures that classes are balanced
         min_length = min([len(l) for l in self.indices])
         n_shot_full = min(n_shot_full, min_length)
 
-        self.keys = []
-        for l in self.indices:
-            self.keys += l[:n_shot_full]
+        self.keys = np.concatenate([l[:n_shot_full] for l in self.indices])
 
     def __getitem__(self, key):
         return self.underlying_dataset[self.keys[key]]
@@ -101,10 +107,14 @@ class InfiniteUniformClassLoader(DataLoader):
                  dataset,
                  n_shot,
                  n_way=None,
+                 rng=None,
                  ):
         self.dataset = dataset
+        # Samples with the global np.random state unless given a Generator.
+        # Resolved at sampling time, since a module cannot be pickled.
+        self.rng = rng
         y_array = dataset.targets
-        self.indices = get_separated_indices(y_array)
+        self.indices = list(groupby_indices(y_array).values())
         self.n_classes = len(self.indices)
         self.n_shot = n_shot
         self.n_way = n_way
@@ -120,43 +130,123 @@ class InfiniteUniformClassLoader(DataLoader):
         raise NotImplementedError
 
     def next(self, qy=None):
+        rng = self.rng if self.rng is not None else np.random
         if self.n_way:
             assert len(qy) <= self.n_way, "qy must be smaller than n_way"
             qy = qy.cpu().detach().numpy()
             probs = np.ones(len(self.indices))
             probs[qy] = 0
             probs /= probs.sum()
-            subclasses = np.random.choice(self.n_classes, size=(self.n_way-len(qy)), replace=False, p=probs)
+            subclasses = rng.choice(self.n_classes, size=(self.n_way-len(qy)), replace=False, p=probs)
 
             subclasses = np.concatenate([subclasses, qy])
             indices = [self.indices[i] for i in subclasses] 
         else:
             indices = self.indices
 
-        support_idxs = np.array([np.random.choice(
+        support_idxs = np.array([rng.choice(
             row, size=self.n_shot, replace=False) for row in indices]).flatten()
 
         # Get support data from dataset and collate into mini-batch
         return self.collate_fn([self.dataset[i] for i in support_idxs])
 
-def get_separated_indices(vals):
+class RandomEnvLoader:
+    '''Samples each support from a single, uniformly chosen environment.'''
+    def __init__(self, loaders, rng=None):
+        self.loaders = loaders
+        self.rng = rng
+
+    @property
+    def rng(self):
+        return self._rng
+
+    @rng.setter
+    def rng(self, rng):
+        # Environment loaders share the generator, so one seed controls all sampling
+        self._rng = rng
+        for loader in self.loaders:
+            loader.rng = rng
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def next(self, qy=None):
+        rng = self._rng if self._rng is not None else np.random
+        return self.loaders[rng.choice(len(self.loaders))].next()
+
+class _InfiniteBatches(IterableDataset):
+    '''Streams batches from an infinite loader, sampling with its own generator.'''
+    def __init__(self, loader, seed):
+        super().__init__()
+        self.loader = loader
+        self.seed = seed
+
+    def __iter__(self):
+        self.loader.rng = np.random.default_rng(self.seed)
+        while True:
+            yield self.loader.next()
+
+class BackgroundLoader:
+    '''Prefetches batches from an infinite loader in a DataLoader worker process,
+    so that next() pops already collated batches.
+
+    The worker is started on the first next() and samples with its own
+    generator, seeded once from np.random at construction, so sampling does
+    not depend on the global np.random state during training.
+    Once sampling fails, the same error is raised on every later call.
     '''
-    Separates a list of values into a list of lists,
-    where each list is the indices of a fixed label/attribute.
+    def __init__(self, loader, max_prefetch=4, seed=None):
+        if seed is None:
+            seed = np.random.randint(2**31)
+        self.stream = DataLoader(_InfiniteBatches(loader, seed), batch_size=None,
+                                 num_workers=1, persistent_workers=True,
+                                 prefetch_factor=max_prefetch)
+        self._iter = None
+        self._error = None
 
-    Maps labels/attributes to natural numbers, if needed.
-    
-    E.g. [0, 1, 1, 2, 3] -> [[0], [1, 2], [3], [4]]
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._error is not None:
+            raise self._error
+        if self._iter is None:
+            self._iter = iter(self.stream)
+        try:
+            return next(self._iter)
+        except Exception as e:
+            self._error = e
+            raise
+
+    def next(self, qy=None):
+        return self.__next__()
+
+def groupby_indices(vals):
+    '''
+    Groups indices of an array by value with a single stable sort.
+
+    Returns a dict mapping each unique value (in sorted order) to the
+    array of indices where it occurs.
+
+    E.g. [0, 1, 1, 2, 0] -> {0: [0, 4], 1: [1, 2], 2: [3]}
     '''
     if torch.is_tensor(vals):
         vals = vals.cpu().detach().numpy()
-    num_unique_vals = len(np.unique(vals))
-    # Map (potentially non-consecutive) labels to (consecutive) natural numbers
-    d = dict([(y,x) for x,y in enumerate(sorted(set(vals)))])
-    indices = [[] for _ in range(num_unique_vals)]
-    for i, c in enumerate(vals):
-        indices[d[c]].append(i)
-    return indices
+    vals = np.asarray(vals)
+    order = np.argsort(vals, kind='stable')
+    # Dense non-negative integer ids (e.g. env ids) get their bounds from
+    # bincount; sparse or large ids would make its counter array too big.
+    if (np.issubdtype(vals.dtype, np.integer) and np.can_cast(vals.dtype, np.intp)
+            and len(vals) and vals.min() >= 0 and vals.max() <= 2 * len(vals)):
+        counts = np.bincount(vals)
+        offsets = np.concatenate([[0], counts.cumsum()])
+        return {u: order[offsets[u]:offsets[u+1]] for u in np.flatnonzero(counts)}
+    uniq, starts = np.unique(vals[order], return_index=True)
+    ends = np.append(starts[1:], len(vals))
+    return {u: order[s:e] for u, s, e in zip(uniq, starts, ends)}
 
 def linear_normalization(arr, new_range=(0, 1)):
     """Linearly normalizes a batch of images into new_range
@@ -176,21 +266,40 @@ def linear_normalization(arr, new_range=(0, 1)):
     return (arr - min_per_batch) * (new_range[1]-new_range[0]) / (max_per_batch - min_per_batch) + new_range[0]
 
 class KNN:
-    '''KNN.'''
-    def __init__(self, data, labels, n_neighbors=20) -> None:
+    '''Exact KNN, computed with a single GEMM on the query's device.
+
+    :param data_sq: Optional precomputed squared norms of data
+    '''
+    def __init__(self, data, labels, n_neighbors=20, data_sq=None) -> None:
         self.data = data
         self.labels = labels
         self.n_neighbors = n_neighbors
+        self.data_sq = data_sq if data_sq is not None else (data * data).sum(dim=1)
+        self._device_cache = {}
     
     def __call__(self, x):
         '''Query for nearest neighbors'''
-        distances = -torch.cdist(x, self.data.to(x.device))
-        indices = torch.argsort(distances, dim=-1, descending=True).cpu().detach().numpy()
-        indices = indices[:, :self.n_neighbors]
-
-        data = torch.cat([self.data[ind] for ind in indices], dim=0)
-        labels = torch.cat([self.labels[ind] for ind in indices], dim=0)
-        return data, labels
+        data, labels = self.batched(x)
+        return data.flatten(0, 1), labels.flatten()
+
+    def batched(self, x):
+        '''Query for nearest neighbors of a batch with a single GEMM.
+        Returns per-query neighbors (b, k, feat_dim) and labels (b, k).'''
+        data, data_sq, labels = self._on_device(x.device)
+        # ||x||^2 is constant per row, so it does not affect the ranking
+        distances = torch.addmm(data_sq[None], x, data.T, alpha=-2)
+        _, indices = distances.topk(self.n_neighbors, dim=-1, largest=False)
+        return data[indices], labels[indices]
+
+    def _on_device(self, device):
+        '''Copies data, squared norms and labels to device once and reuses them.'''
+        if device not in self._device_cache:
+            self._device_cache[device] = (
+                self.data.to(device, non_blocking=True),
+                self.data_sq.to(device, non_blocking=True),
+                self.labels.to(device, non_blocking=True),
+            )
+        return self._device_cache[device]
 
 class HNSW:
     '''HNSW index for fast approximate nearest neighbor search.'''
@@ -203,44 +312,133 @@ class HNSW:
         self.index = hnswlib.Index(space='l2', dim=self.dim)
 
         # Initialize the index and add data points
-        self.index.init_index(max_elements=num_elements, ef_construction=100, M=16)
-        self.index.add_items(data)
+        self.index.init_index(max_elements=num_elements, ef_construction=200, M=16)
+        self.index.add_items(_to_float32_numpy(data), np.arange(num_elements))
     
     def __call__(self, x):
         '''Query for nearest neighbors'''
+        indices, _ = self.index.knn_query(_to_float32_numpy(x), k=self.n_neighbors)
+        return _gather_neighbors(self.data, self.labels, indices)
+
+    def batched(self, x):
+        '''Query for nearest neighbors of a batch, parallelized across queries.
+        Returns per-query neighbors (b, k, feat_dim) and labels (b, k).'''
+        self.index.set_num_threads(os.cpu_count())
+        indices, _ = self.index.knn_query(_to_float32_numpy(x), k=self.n_neighbors)
+        data, labels = _gather_neighbors(self.data, self.labels, indices)
+        return data.view(len(x), self.n_neighbors, -1), labels.view(len(x), self.n_neighbors)
+
+def _to_float32_numpy(x):
+    if torch.is_tensor(x):
         x = x.cpu().detach().numpy()
-        indices, _ = self.index.knn_query(x, k=self.n_neighbors)
-        indices = indices.astype(np.int64)
-        data = torch.cat([self.data[ind] for ind in indices], dim=0)
-        labels = torch.cat([self.labels[ind] for ind in indices], dim=0)
-        return data, labels
+    return np.ascontiguousarray(x, dtype=np.float32)
+
+def _gather_neighbors(data, labels, indices):
+    '''Gathers (n_query*k) neighbor features and labels with a single index_select.'''
+    indices = torch.from_numpy(indices.astype(np.int64).reshape(-1))
+    return data.index_select(0, indices), labels.index_select(0, indices)
+
+# Classes larger than this are clustered with MiniBatchKMeans
+MINIBATCH_KMEANS_THRESHOLD = 2000
+# Small classes of low-dimensional embeddings use the Numba kernel, if available
+NUMBA_KMEANS_MAX_DIM = 64
+NUMBA_KMEANS_MAX_POINTS = 5000
 
-def compute_clusters(embeddings, labels, n_clusters, closest=False):
+def fit_kmeans(x, n_clusters):
+    '''Fits k-means on a single class of embeddings and returns the cluster centers.
+
+    Uses the Numba Lloyd kernel for small, low-dimensional classes, MiniBatchKMeans
+    for large classes, and Elkan's KMeans otherwise, with a single initialization.
+    '''
+    if torch.is_tensor(x):
+        x = x.cpu().detach().numpy()
+    x = np.ascontiguousarray(x, dtype=np.float32)
+    # A single cluster's optimal centroid is the mean; Elkan also warns for k=1
+    if n_clusters == 1:
+        return x.mean(axis=0, keepdims=True)
+    if (kmeans_lloyd is not None and x.shape[1] <= NUMBA_KMEANS_MAX_DIM
+            and len(x) < NUMBA_KMEANS_MAX_POINTS):
+        return kmeans_lloyd(x, n_clusters, n_iter=100, random_state=0)
+    if len(x) > MINIBATCH_KMEANS_THRESHOLD:
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, n_init=1, max_iter=100,
+                                 tol=1e-4, random_state=0)
+    else:
+        kmeans = KMeans(n_clusters=n_clusters, n_init=1, max_iter=100,
+                        tol=1e-4, algorithm='elkan', random_state=0)
+    return kmeans.fit(x).cluster_centers_
+
+def _fit_centroids(x, n_clusters):
+    # Limit BLAS/OpenMP threads in each worker to avoid oversubscription.
+    # threadpoolctl does not control numba's threading layer, so set it too.
+    # Restore the previous value, since joblib may run this in the main process.
+    if kmeans_lloyd is not None:
+        prev_numba_threads = get_numba_threads()
+        set_numba_threads(1)
+    try:
+        with threadpool_limits(limits=1):
+            return fit_kmeans(x, n_clusters)
+    finally:
+        if kmeans_lloyd is not None:
+            set_numba_threads(prev_numba_threads)
+
+def compute_clusters(embeddings, labels, n_clusters, closest=False, label_index=None,
+                     embeddings_sq=None):
     '''Performs k-means clustering to find support set.
     
     :param closest: If True, uses support features closest to cluster centroids. Otherwise,
                 uses true cluster centroids.
+    :param label_index: Optional precomputed output of groupby_indices(labels)
+    :param embeddings_sq: Optional precomputed squared norms of embeddings
     '''
-    img_ids = np.arange(len(embeddings))
-    sfeat = []
+    if label_index is None:
+        label_index = groupby_indices(labels)
+    uniq = list(label_index.keys())
+    lengths = np.array([len(ind) for ind in label_index.values()])
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+
+    # Permute once so that each class occupies a contiguous range,
+    # rather than building a boolean mask per class. This is the only copy
+    # of the embeddings; per-class slices emb_sorted[s:e] are views.
+    order = np.concatenate(list(label_index.values()))
+    if torch.is_tensor(embeddings):
+        emb_sorted = embeddings.index_select(0, torch.from_numpy(order).to(embeddings.device)).contiguous()
+    else:
+        emb_sorted = np.ascontiguousarray(embeddings[order])
+
+    # Convert to contiguous float32 once, rather than per class
+    emb_np = _to_float32_numpy(emb_sorted)
+
+    # Per-class fits are independent, so run them in parallel
+    results = Parallel(n_jobs=-1, prefer='processes')(
+        delayed(_fit_centroids)(emb_np[s:e], n_clusters) for s, e in zip(starts, ends))
+    centroids = []
     slabel = []
-    for c in np.unique(labels):
-        embeddings_class = embeddings[labels==c]
-        img_ids_class = img_ids[labels==c]
-        kmeans = KMeans(n_clusters=n_clusters, random_state=0).fit(embeddings_class)
-        centroids = torch.tensor(kmeans.cluster_centers_).float()
+    for c, class_centroids in zip(uniq, results):
+        centroids.append(torch.tensor(class_centroids).float())
         slabel += [c] * n_clusters 
-        if closest:
-            dist_matrix = torch.cdist(centroids, embeddings_class)
-            min_indices = dist_matrix.argmin(dim=-1)
-            dataset_indices = img_ids_class[min_indices]
-            if n_clusters == 1:
-                dataset_indices = [dataset_indices]
-            closest_embedding = embeddings[dataset_indices]
-            sfeat.append(closest_embedding)
-        else:
-            sfeat.append(centroids)
-
-    sfeat = torch.cat(sfeat, dim=0)
+    centroids = torch.cat(centroids, dim=0)
     slabel = torch.tensor(slabel)
+
+    if not closest:
+        return centroids, slabel
+
+    # Per-class distances ||b||^2 - 2ab^T against the class's contiguous slice.
+    # ||a||^2 is constant per centroid, so it does not affect the argmin.
+    emb_sorted = torch.as_tensor(emb_sorted).float().contiguous()
+    centroids = centroids.to(emb_sorted.device)
+    if embeddings_sq is not None:
+        emb_sq = embeddings_sq.index_select(0, torch.from_numpy(order).to(embeddings_sq.device))
+        emb_sq = emb_sq.to(emb_sorted.device)
+    else:
+        emb_sq = (emb_sorted * emb_sorted).sum(dim=1)
+
+    sorted_indices = []
+    for i, (s, e) in enumerate(zip(starts, ends)):
+        class_centroids = centroids[i*n_clusters:(i+1)*n_clusters]
+        dist_matrix = torch.addmm(emb_sq[None, s:e], class_centroids, emb_sorted[s:e].T, alpha=-2)
+        sorted_indices.append(dist_matrix.argmin(dim=-1) + int(s))
+    sorted_indices = torch.cat(sorted_indices).cpu().numpy()
+    dataset_indices = order[sorted_indices]
+    sfeat = embeddings[dataset_indices]
     return sfeat, slabel
\ No newline at end of file